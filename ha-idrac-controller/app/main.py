@@ -55,6 +55,13 @@ def determine_server_generation(model_name):
         except (IndexError, ValueError): pass
     return False
 
+_FAN_SLUG_INVALID_CHARS = re.compile(r'[^a-zA-Z0-9_]+')
+
+def fan_rpm_sensor_slug(index, fan_name):
+    safe_fan_name_slug = _FAN_SLUG_INVALID_CHARS.sub('_', fan_name).lower().strip('_')
+    if not safe_fan_name_slug: safe_fan_name_slug = f"fan_{index}"
+    return f"fan_{safe_fan_name_slug}_rpm"
+
 def celsius_to_fahrenheit(celsius):
     if celsius is None: return None
     return round((celsius * 9/5) + 32, 1)
@@ -209,22 +216,18 @@ def main_control_loop(mqtt_handler):
                         slug = f"cpu_{i}_temp"
                         mqtt_handler.publish_sensor_discovery(
                             sensor_type_slug=slug, sensor_name=f"CPU {i} Temperature",
-                            device_class="temperature", unit_of_measurement="°C",
-                            value_template="{{ value_json.temperature | round(1) }}"
+                            device_class="temperature", unit_of_measurement="°C"
                         )
                         new_cpu_slugs.add(slug)
                     discovered_cpu_sensors = new_cpu_slugs
                 
                 for i, fan_info in enumerate(parsed_fan_rpms):
                     fan_name = fan_info["name"]
-                    safe_fan_name_slug = re.sub(r'[^a-zA-Z0-9_]+', '_', fan_name).lower().strip('_')
-                    if not safe_fan_name_slug: safe_fan_name_slug = f"fan_{i}"
-                    rpm_sensor_slug = f"fan_{safe_fan_name_slug}_rpm"
+                    rpm_sensor_slug = fan_rpm_sensor_slug(i, fan_name)
                     if rpm_sensor_slug not in discovered_fan_rpm_sensors:
                         mqtt_handler.publish_sensor_discovery(
                             sensor_type_slug=rpm_sensor_slug, sensor_name=f"{fan_name} RPM",
-                            unit_of_measurement="RPM", icon="mdi:fan",
-                            value_template="{{ value_json.rpm | round(0) }}"
+                            unit_of_measurement="RPM", icon="mdi:fan"
                         )
                         discovered_fan_rpm_sensors.add(rpm_sensor_slug)
 
@@ -276,35 +279,23 @@ def main_control_loop(mqtt_handler):
 
             # --- MQTT State Publishing ---
             if mqtt_handler and mqtt_handler.is_connected:
-                # (Keep existing MQTT state publishing logic for temps, target fan speed, hottest cpu, power, fan rpms)
-                # CPU Temps
-                for i, cpu_temp_val in enumerate(cpu_temps_list_c):
-                    mqtt_handler.publish_sensor_state(sensor_type_slug=f"cpu_{i}_temp", value_dict={"temperature": cpu_temp_val})
-                # Inlet/Exhaust
-                if parsed_temperatures_c.get("inlet_temp") is not None:
-                     mqtt_handler.publish_sensor_state(sensor_type_slug="inlet_temp", value_dict={"temperature": parsed_temperatures_c["inlet_temp"]})
-                if parsed_temperatures_c.get("exhaust_temp") is not None:
-                     mqtt_handler.publish_sensor_state(sensor_type_slug="exhaust_temp", value_dict={"temperature": parsed_temperatures_c["exhaust_temp"]})
-                # Hottest CPU
-                if hottest_cpu_temp_c is not None:
-                    mqtt_handler.publish_sensor_state(sensor_type_slug="hottest_cpu_temp", value_dict={"temperature": hottest_cpu_temp_c})
-                # Target Fan Speed
+                # Every sensor reads its own key from one aggregated state message (None renders as unknown)
+                sensor_states = {f"cpu_{i}_temp": cpu_temp_val for i, cpu_temp_val in enumerate(cpu_temps_list_c)}
+                sensor_states["inlet_temp"] = parsed_temperatures_c.get("inlet_temp")
+                sensor_states["exhaust_temp"] = parsed_temperatures_c.get("exhaust_temp")
+                sensor_states["hottest_cpu_temp"] = hottest_cpu_temp_c
+                # Target Fan Speed (None is shown as 'Auto')
+                sensor_states["target_fan_speed"] = None
                 if target_fan_speed_display not in ["N/A", "Dell Auto", "Dell Auto (Safety)"]:
                     try: # Ensure it's an int before publishing if template expects number
-                        mqtt_handler.publish_sensor_state(sensor_type_slug="target_fan_speed", value_dict={"speed": int(target_fan_speed_display)})
+                        sensor_states["target_fan_speed"] = int(target_fan_speed_display)
                     except ValueError:
-                        mqtt_handler.publish_sensor_state(sensor_type_slug="target_fan_speed", value_dict={"speed": None}) # Or publish the string "Auto"
-                else: 
-                     mqtt_handler.publish_sensor_state(sensor_type_slug="target_fan_speed", value_dict={"speed": None}) 
-                # Power Consumption
-                if power_consumption_watts is not None:
-                    mqtt_handler.publish_sensor_state(sensor_type_slug="power_consumption", value_dict={"power": power_consumption_watts})
+                        pass
+                sensor_states["power_consumption"] = power_consumption_watts
                 # Actual Fan RPMs
                 for i, fan_info in enumerate(parsed_fan_rpms):
-                    fan_name = fan_info["name"]
-                    safe_fan_name_slug = re.sub(r'[^a-zA-Z0-9_]+', '_', fan_name).lower().strip('_')
-                    if not safe_fan_name_slug: safe_fan_name_slug = f"fan_{i}"
-                    mqtt_handler.publish_sensor_state(sensor_type_slug=f"fan_{safe_fan_name_slug}_rpm", value_dict={"rpm": fan_info["rpm"]})
+                    sensor_states[fan_rpm_sensor_slug(i, fan_info["name"])] = fan_info["rpm"]
+                mqtt_handler.publish_sensor_states(sensor_states)
 
             print(f"[{log_level.upper()}] --- Cycle {loop_count + 1} End ---", flush=True)
         
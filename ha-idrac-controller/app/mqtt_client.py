@@ -1,28 +1,96 @@
 # HA-iDRAC/ha-idrac-controller/app/mqtt_client.py
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 import os
 import time
+import socket
+import threading
+import contextlib
+import hashlib
 import json
-import re # For sanitizing fan names
+from dataclasses import dataclass, field
+
+try:
+    import orjson # Native encoder; returns bytes, which paho publishes without re-encoding
+    _dumps = orjson.dumps
+except ImportError:
+    # One reusable encoder emitting the same compact UTF-8 output as orjson
+    _json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+    def _dumps(obj):
+        return _json_encoder.encode(obj).encode()
+
+_DOT_TO_UNDERSCORE = str.maketrans(".:", "__") # IPv4 dots and IPv6 colons in one pass
+_STATUS_TOPIC = "ha_idrac_controller/status"
+_ONLINE = b"online"
+_OFFLINE = b"offline"
+
+def _dumps_with_device(payload, device_fragment):
+    """Encodes a (non-empty) discovery payload and splices in a pre-encoded "device" value."""
+    return _dumps(payload)[:-1] + b',"device":' + device_fragment + b"}"
+
+@dataclass(slots=True, frozen=True)
+class DeviceInfo:
+    """Device block for MQTT discovery; its JSON encodings are computed once at construction."""
+    identifier: str
+    name: str
+    model: str
+    manufacturer: str
+    json_fragment: bytes = field(init=False, repr=False) # Full device block
+    ref_json_fragment: bytes = field(init=False, repr=False) # Identifiers only, for entities after the first
+
+    def __post_init__(self):
+        object.__setattr__(self, "json_fragment", _dumps({
+            "identifiers": [self.identifier],
+            "name": self.name,
+            "model": self.model,
+            "manufacturer": self.manufacturer
+        }))
+        object.__setattr__(self, "ref_json_fragment", _dumps({"identifiers": [self.identifier]}))
 
 class MqttClient:
+    __slots__ = ("client_id", "client", "broker_address", "port", "username", "password",
+                 "is_connected", "device_info", "log_level", "_log_threshold",
+                 "_static_discoveries", "_state_topic",
+                 "_device_block_emitted", "_discovery_hash", "_last_published_hash",
+                 "_topic_aliases", "_topic_alias_max", "_last_telemetry_info",
+                 "_status_config_topic", "_status_config_payload", "_legacy_status_config_topic")
+
+    _LVL_TRACE, _LVL_DEBUG, _LVL_INFO, _LVL_WARNING, _LVL_ERROR, _LVL_FATAL = -1, 0, 1, 2, 3, 4
+    _LOG_LEVELS = {"trace": _LVL_TRACE, "debug": _LVL_DEBUG, "info": _LVL_INFO,
+                   "warning": _LVL_WARNING, "error": _LVL_ERROR, "fatal": _LVL_FATAL}
+    _UNCORK_DELAY = 0.05 # Seconds; lets paho's loop write the queued burst before the cork is released
+    _SESSION_EXPIRY_SECONDS = 86400 # How long the broker keeps our session across disconnects
+
     def __init__(self, client_id="ha_idrac_controller_2"):
         self.client_id = client_id
-        self.client = mqtt.Client(client_id=self.client_id, protocol=mqtt.MQTTv311)
+        self.client = mqtt.Client(client_id=self.client_id, protocol=mqtt.MQTTv5)
         self.broker_address = "core-mosquitto" # Default, will be overridden by main.py
         self.port = 1883
         self.username = ""
         self.password = ""
         self.is_connected = False
-        self.device_info_dict = None # This will be set by main.py after server_info is fetched
+        self.device_info = None # DeviceInfo; set by main.py after server_info is fetched
         self.log_level = "info" # Default, can be updated from main.py
+        self._log_threshold = self._LVL_INFO
+        self._static_discoveries = [] # (topic, payload_bytes) pairs, built in set_device_info
+        self._state_topic = None # Single JSON state topic shared by every sensor of this device
+        self._device_block_emitted = False # Full device block goes out with the first sensor discovery only
+        self._discovery_hash = None # Digest of _static_discoveries
+        self._last_published_hash = None # Digest of the static discoveries last sent to the broker
+        self._topic_aliases = {} # state topic -> PUBLISH Properties carrying its TopicAlias (per connection)
+        self._topic_alias_max = 0 # TopicAliasMaximum granted by the broker in CONNACK
+        self._last_telemetry_info = None # MQTTMessageInfo of the newest telemetry publish on this connection
+        self._status_config_topic = None # Connectivity binary_sensor discovery, built in set_device_info
+        self._status_config_payload = None
+        self._legacy_status_config_topic = None # Double-prefixed topic used by older versions, cleared if still retained
 
         self.client.on_connect = self.on_connect
         self.client.on_disconnect = self.on_disconnect
+        self.client.on_message = self._on_message
 
     def _log(self, level, message):
-        levels = {"trace": -1, "debug": 0, "info": 1, "warning": 2, "error": 3, "fatal": 4}
-        if levels.get(self.log_level, levels["info"]) <= levels.get(level.lower(), levels["info"]):
+        if self._log_threshold <= self._LOG_LEVELS.get(level, self._LVL_INFO):
             print(f"[{level.upper()}] MQTT: {message}", flush=True)
 
     def configure_broker(self, host, port, username, password, log_level="info"):
@@ -31,56 +99,123 @@ class MqttClient:
         self.username = username
         self.password = password
         self.log_level = log_level.lower()
+        self._log_threshold = self._LOG_LEVELS.get(self.log_level, self._LVL_INFO) # e.g. "notice" behaves like info
         if self.username: # Only set if username is actually provided
             self.client.username_pw_set(self.username, self.password)
+        # paho only applies these limits to QoS>0 messages; QoS 0 telemetry is bounded in publish_fast
+        self.client.max_inflight_messages_set(100)
+        self.client.max_queued_messages_set(1000)
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
+        # TCP_NODELAY is deliberately left off: the reconnect burst relies on TCP_CORK/Nagle to coalesce frames
 
     def set_device_info(self, manufacturer, model, ip_address):
-        sanitized_ip = ip_address.replace('.', '_') if ip_address else "default_ip"
-        self.device_info_dict = {
-            "identifiers": [f"idrac_controller_{sanitized_ip}_device"],
-            "name": f"iDRAC Controller ({ip_address or 'N/A'})",
-            "model": model or "HA iDRAC Controller",
-            "manufacturer": manufacturer or "HA Add-on" # Changed from Aesgarth for generality
-        }
-        self._log("info", f"Device info for MQTT discovery set to: {self.device_info_dict}")
+        sanitized_ip = ip_address.translate(_DOT_TO_UNDERSCORE) if ip_address else "default_ip"
+        self.device_info = DeviceInfo(
+            identifier=f"idrac_controller_{sanitized_ip}_device",
+            name=f"iDRAC Controller ({ip_address or 'N/A'})",
+            model=model or "HA iDRAC Controller",
+            manufacturer=manufacturer or "HA Add-on" # Changed from Aesgarth for generality
+        )
+        self._state_topic = f"ha_idrac_controller/sensor/{self.device_info.identifier}/state"
+        self._device_block_emitted = False
+        self._static_discoveries = self._build_static_sensor_discoveries()
+        self._status_config_topic = f"homeassistant/binary_sensor/{self.device_info.identifier}/status/config"
+        self._status_config_payload = _dumps_with_device({
+            "name": "iDRAC Controller Connectivity",
+            "state_topic": _STATUS_TOPIC,
+            # New unique_id: the entity discovered from the legacy topic is removed, not moved
+            "unique_id": f"{self.device_info.identifier}_connectivity",
+            "device_class": "connectivity",
+            "payload_on": "online",
+            "payload_off": "offline"
+        }, self.device_info.json_fragment)
+        self._legacy_status_config_topic = f"homeassistant/binary_sensor/idrac_controller_{self.device_info.identifier}/status/config"
+        self._discovery_hash = hashlib.blake2b(b"".join(p for _, p in self._static_discoveries), digest_size=8).digest()
+        self._log("info", f"Device info for MQTT discovery set to: {self.device_info}")
 
 
-    def on_connect(self, client, userdata, flags, rc):
+    def on_connect(self, client, userdata, flags, rc, properties=None):
         if rc == 0:
             self._log("info", f"Connected successfully to broker {self.broker_address}:{self.port}")
+            # Topic aliases only live for one connection
+            self._topic_aliases = {}
+            self._topic_alias_max = getattr(properties, "TopicAliasMaximum", 0)
+            self._last_telemetry_info = None # Frames queued on an earlier connection are never written
             self.is_connected = True
             
-            # Publish general add-on availability status sensor
-            if self.device_info_dict:
-                status_config_topic = f"homeassistant/binary_sensor/idrac_controller_{self.device_info_dict['identifiers'][0]}/status/config"
-                status_config_payload = {
-                    "name": "iDRAC Controller Connectivity",
-                    "state_topic": "ha_idrac_controller/status",
-                    "unique_id": f"idrac_controller_{self.device_info_dict['identifiers'][0]}_connectivity",
-                    "device_class": "connectivity",
-                    "payload_on": "online",
-                    "payload_off": "offline",
-                    "device": self.device_info_dict
-                }
-                self.publish(status_config_topic, json.dumps(status_config_payload), retain=True)
-            self.publish("ha_idrac_controller/status", "online", retain=True)
-
-            # Static sensor discoveries (non-CPU, non-FanRPM which are dynamic)
-            self.publish_static_sensor_discoveries()
+            # Corking coalesces the whole reconnect burst into as few TCP segments as possible
+            with self._corked():
+                # Publish general add-on availability status sensor
+                if self.device_info:
+                    if self._legacy_status_config_topic:
+                        # The broker replays the old config only if it is still retained; _on_message clears it
+                        self.client.subscribe(self._legacy_status_config_topic, qos=0)
+                    self.publish(self._status_config_topic, self._status_config_payload, retain=True)
+                self.publish(_STATUS_TOPIC, _ONLINE, retain=True)
+
+                # Static sensor discoveries (non-CPU, non-FanRPM which are dynamic).
+                # Retained messages are independent of the session: this assumes that if the broker resumed our
+                # session, nobody cleared the retained configs since we last sent them. If that is not true (e.g.
+                # the device was deleted in HA), they come back on the next clean connect or process restart.
+                if flags.get("session present") and self._last_published_hash == self._discovery_hash:
+                    self._log("info", "Broker session resumed with unchanged static discoveries, skipping republish.")
+                else:
+                    self.publish_static_sensor_discoveries()
         else:
             self._log("error", f"Connection failed with code {rc}")
             self.is_connected = False
 
-    def on_disconnect(self, client, userdata, rc):
+    def on_disconnect(self, client, userdata, rc, properties=None):
         self._log("info", f"Disconnected from broker with result code {rc}.")
         self.is_connected = False
+        self._topic_alias_max = 0
+        self._topic_aliases = {}
+        self._last_telemetry_info = None
+
+    def _on_message(self, client, userdata, msg):
+        legacy_topic = self._legacy_status_config_topic
+        if legacy_topic and msg.topic == legacy_topic:
+            if msg.payload:
+                self._log("info", f"Removing retained connectivity config from legacy topic {legacy_topic}.")
+                self.publish(legacy_topic, b"", retain=True)
+            self.client.unsubscribe(legacy_topic)
+            self._legacy_status_config_topic = None
+
+    def _set_cork(self, sock, enabled):
+        if sock is None or not hasattr(socket, "TCP_CORK"): # TCP_CORK is Linux-only
+            return False
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1 if enabled else 0)
+            return True
+        except (OSError, AttributeError) as e: # e.g. websocket transport wrappers
+            if self._log_threshold <= self._LVL_DEBUG:
+                self._log("debug", f"Could not {'set' if enabled else 'clear'} TCP_CORK: {e}")
+            return False
+
+    @contextlib.contextmanager
+    def _corked(self):
+        """Corks the socket while publishes are queued; paho's loop writes them after the callback returns."""
+        sock = self.client.socket()
+        corked = self._set_cork(sock, True)
+        try:
+            yield
+        finally:
+            if corked:
+                # Never write from inside a paho callback: it holds _in_callback_mutex, which a failed
+                # write's disconnect handling would try to take again. Uncork from a timer instead.
+                uncork = threading.Timer(self._UNCORK_DELAY, self._set_cork, args=(sock, False))
+                uncork.daemon = True
+                uncork.start()
 
     def connect(self):
         if not self.is_connected:
             self._log("info", f"Attempting to connect to broker {self.broker_address}:{self.port}...")
             try:
-                self.client.will_set("ha_idrac_controller/status", payload="offline", qos=1, retain=True)
-                self.client.connect(self.broker_address, self.port, 60)
+                self.client.will_set(_STATUS_TOPIC, payload=_OFFLINE, qos=1, retain=True)
+                # Persistent session so a reconnect can report "session present" and skip redundant discovery
+                connect_properties = Properties(PacketTypes.CONNECT)
+                connect_properties.SessionExpiryInterval = self._SESSION_EXPIRY_SECONDS
+                self.client.connect(self.broker_address, self.port, 60, clean_start=False, properties=connect_properties)
                 self.client.loop_start() 
             except ConnectionRefusedError:
                 self._log("error", f"Connection refused by broker {self.broker_address}:{self.port}.")
@@ -92,7 +227,7 @@ class MqttClient:
     def disconnect(self):
         if self.is_connected:
             # LWT should handle setting status to offline
-            # self.publish("ha_idrac_controller/status", "offline", retain=True) 
+            # self.publish(_STATUS_TOPIC, _OFFLINE, retain=True) 
             self.client.loop_stop()
             self.client.disconnect()
             self._log("info", "Gracefully disconnected.")
@@ -113,94 +248,131 @@ class MqttClient:
             self._log("warning", f"Not connected. Cannot publish to {topic}.")
         return False
 
-    def publish_sensor_discovery(self, sensor_type_slug, sensor_name, 
-                                 device_class=None, unit_of_measurement=None, 
-                                 icon=None, value_template=None, 
-                                 entity_category=None, unique_id_suffix=None,
-                                 state_class=None): # <<< ADD state_class=None HERE
-        if not self.device_info_dict:
-            self._log("warning", f"Device info not set. Cannot publish discovery for {sensor_name}.")
+    def publish_fast(self, topic, payload):
+        """QoS 0, non-retained telemetry publish; socket errors surface through on_disconnect."""
+        # paho queues QoS 0 frames without limit; QoS 0 counts as published once written to the socket,
+        # so drop a sample while the previous one is still unsent instead of piling up stale readings
+        last_info = self._last_telemetry_info
+        if last_info is not None and not last_info.is_published():
+            self._log("warning", f"Previous telemetry for {topic} not yet sent, dropping this sample.")
             return
+        properties = self._topic_aliases.get(topic)
+        if properties is not None: # Alias already bound on this connection, so send it without the topic
+            msg_info = self.client.publish("", payload, qos=0, retain=False, properties=properties)
+        else:
+            if len(self._topic_aliases) < self._topic_alias_max:
+                properties = Properties(PacketTypes.PUBLISH)
+                properties.TopicAlias = len(self._topic_aliases) + 1
+                self._topic_aliases[topic] = properties
+            msg_info = self.client.publish(topic, payload, qos=0, retain=False, properties=properties)
+        # is_published() raises for failed enqueues, and such a message never goes out anyway
+        self._last_telemetry_info = msg_info if msg_info.rc == mqtt.MQTT_ERR_SUCCESS else None
+
+    def _device_block(self):
+        """Encoded device info: full for the first discovered sensor; HA links later ones by identifiers alone."""
+        if self._device_block_emitted:
+            return self.device_info.ref_json_fragment
+        self._device_block_emitted = True
+        return self.device_info.json_fragment
+
+    def _build_sensor_discovery(self, sensor_type_slug, sensor_name,
+                                device_class=None, unit_of_measurement=None,
+                                icon=None, value_template=None,
+                                entity_category=None, unique_id_suffix=None,
+                                state_class=None):
+        """Returns (config_topic, payload_bytes, unique_id) for a sensor discovery message.
 
-        base_unique_id = f"{self.device_info_dict['identifiers'][0]}_{sensor_type_slug}"
+        Every sensor reads the shared state topic; without an explicit value_template it
+        picks its own key (slug + suffix) out of the JSON object, rendering None when absent.
+        """
+        base_unique_id = f"{self.device_info.identifier}_{sensor_type_slug}"
         if unique_id_suffix: 
             base_unique_id = f"{base_unique_id}_{unique_id_suffix}"
 
         # Use a consistent node_id for all sensors of this device to group them under the device in MQTT integration
-        node_id_for_topic = self.device_info_dict['identifiers'][0] 
+        node_id_for_topic = self.device_info.identifier 
         # Sanitize slug further if needed, but usually identifier is okay
         config_topic_slug_part = f"{sensor_type_slug}{(unique_id_suffix if unique_id_suffix else '')}"
         
         config_topic = f"homeassistant/sensor/{node_id_for_topic}/{config_topic_slug_part}/config"
-        state_topic_base = f"ha_idrac_controller/sensor/{node_id_for_topic}" # Base for all sensor states of this device
         
         payload = {
             "name": f"{sensor_name}", 
-            "state_topic": f"{state_topic_base}/{config_topic_slug_part}/state",
+            "state_topic": self._state_topic,
             "unique_id": base_unique_id,
-            "device": self.device_info_dict,
-            "availability_topic": "ha_idrac_controller/status",
+            "availability_topic": _STATUS_TOPIC,
             "payload_available": "online",
             "payload_not_available": "offline"
         }
         if device_class: payload["device_class"] = device_class
         if unit_of_measurement: payload["unit_of_measurement"] = unit_of_measurement
         if icon: payload["icon"] = icon
-        if value_template: payload["value_template"] = value_template
+        payload["value_template"] = value_template or f"{{{{ value_json.get('{config_topic_slug_part}') }}}}"
         if entity_category: payload["entity_category"] = entity_category
-        if state_class: payload["state_class"] = state_class # <<< ADD THIS LINE TO INCLUDE IT IN PAYLOAD
+        if state_class: payload["state_class"] = state_class
+
+        return config_topic, _dumps_with_device(payload, self._device_block()), base_unique_id
+
+    def publish_sensor_discovery(self, sensor_type_slug, sensor_name, 
+                                 device_class=None, unit_of_measurement=None, 
+                                 icon=None, value_template=None, 
+                                 entity_category=None, unique_id_suffix=None,
+                                 state_class=None):
+        if not self.device_info:
+            self._log("warning", f"Device info not set. Cannot publish discovery for {sensor_name}.")
+            return
 
-        self.publish(config_topic, json.dumps(payload), retain=True)
-        self._log("debug", f"Published discovery for '{sensor_name}' (unique_id: {base_unique_id}) on topic {config_topic}")
+        config_topic, payload, base_unique_id = self._build_sensor_discovery(
+            sensor_type_slug, sensor_name, device_class=device_class,
+            unit_of_measurement=unit_of_measurement, icon=icon,
+            value_template=value_template, entity_category=entity_category,
+            unique_id_suffix=unique_id_suffix, state_class=state_class
+        )
+        self.publish(config_topic, payload, retain=True)
+        if self._log_threshold <= self._LVL_DEBUG:
+            self._log("debug", f"Published discovery for '{sensor_name}' (unique_id: {base_unique_id}) on topic {config_topic}")
 
 
+    def _build_static_sensor_discoveries(self):
+        """Pre-serializes discovery for sensors that are always present or have fixed names."""
+        definitions = (
+            # Inlet Temp
+            dict(sensor_type_slug="inlet_temp", sensor_name="Inlet Temperature",
+                 device_class="temperature", unit_of_measurement="°C"),
+            # Exhaust Temp
+            dict(sensor_type_slug="exhaust_temp", sensor_name="Exhaust Temperature",
+                 device_class="temperature", unit_of_measurement="°C"),
+            # Target Fan Speed
+            dict(sensor_type_slug="target_fan_speed", sensor_name="Target Fan Speed",
+                 unit_of_measurement="%", icon="mdi:fan-chevron-up",
+                 value_template="{{ value_json.target_fan_speed if value_json.target_fan_speed is not none else 'Auto' }}"),
+            # Hottest CPU Temp
+            dict(sensor_type_slug="hottest_cpu_temp", sensor_name="Hottest CPU Temp",
+                 device_class="temperature", unit_of_measurement="°C"),
+            # Power Consumption
+            dict(sensor_type_slug="power_consumption", sensor_name="Power Consumption",
+                 device_class="power", unit_of_measurement="W",
+                 state_class="measurement", # For power sensors representing current consumption
+                 icon="mdi:flash"),
+        )
+        return [self._build_sensor_discovery(**d)[:2] for d in definitions]
 
     def publish_static_sensor_discoveries(self):
         """Publishes discovery for sensors that are always present or have fixed names."""
-        if not self.is_connected or not self.device_info_dict:
+        if not self.is_connected or not self.device_info:
             self._log("warning", "MQTT not connected or device_info not set, skipping static discoveries.")
             return
         
         self._log("info", "Publishing static sensor discovery messages...")
-        # Inlet Temp
-        self.publish_sensor_discovery(
-            sensor_type_slug="inlet_temp", sensor_name="Inlet Temperature",
-            device_class="temperature", unit_of_measurement="°C",
-            value_template="{{ value_json.temperature | round(1) }}"
-        )
-        # Exhaust Temp
-        self.publish_sensor_discovery(
-            sensor_type_slug="exhaust_temp", sensor_name="Exhaust Temperature",
-            device_class="temperature", unit_of_measurement="°C",
-            value_template="{{ value_json.temperature | round(1) }}"
-        )
-        # Target Fan Speed
-        self.publish_sensor_discovery(
-            sensor_type_slug="target_fan_speed", sensor_name="Target Fan Speed",
-            unit_of_measurement="%", icon="mdi:fan-chevron-up",
-            value_template="{{ value_json.speed if value_json.speed is not none else 'Auto' }}"
-        )
-        # Hottest CPU Temp
-        self.publish_sensor_discovery(
-            sensor_type_slug="hottest_cpu_temp", sensor_name="Hottest CPU Temp",
-            device_class="temperature", unit_of_measurement="°C",
-            value_template="{{ value_json.temperature | round(1) }}"
-        )
-        # Power Consumption (NEW)
-        self.publish_sensor_discovery(
-            sensor_type_slug="power_consumption", sensor_name="Power Consumption",
-            device_class="power", unit_of_measurement="W",
-            state_class="measurement", # For power sensors representing current consumption
-            icon="mdi:flash",
-            value_template="{{ value_json.power | round(0) }}"
-        )
+        for config_topic, payload in self._static_discoveries:
+            self.publish(config_topic, payload, retain=True)
+        self._last_published_hash = self._discovery_hash
 
 
-    def publish_sensor_state(self, sensor_type_slug, value_dict, unique_id_suffix=None):
-        if not self.device_info_dict:
+    def publish_sensor_states(self, states):
+        """Publishes one poll cycle's readings, keyed by sensor slug, as a single JSON message."""
+        if not self.device_info:
             self._log("warning", "Device info not set. Cannot publish sensor state.")
             return
 
-        state_topic_base = f"ha_idrac_controller/sensor/{self.device_info_dict['identifiers'][0]}"
-        state_topic = f"{state_topic_base}/{sensor_type_slug}{(unique_id_suffix if unique_id_suffix else '')}/state"
-        self.publish(state_topic, json.dumps(value_dict))
+        self.publish_fast(self._state_topic, _dumps(states))